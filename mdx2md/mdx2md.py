@@ -1,7 +1,11 @@
 import re #Regular expressions
+import ast #Parse dictionary literals
 import os #Operating system
 import shutil #Copy images
+import filecmp #Compare copied images
 import argparse
+import functools #Cache resolved imports
+from concurrent.futures import ThreadPoolExecutor #Copy images concurrently
 import sys
 
 # Default value
@@ -34,6 +38,8 @@ else:
 siteBaseUrl = "https://docs.agora.io/en"
 docsPath = repoPath + "/docs"
 assetsPath = docsPath + "/assets"
+outputPath = "./output"
+imagesPath = outputPath + "/images"
 
 if product is None:
     # Get the product name from the path
@@ -45,6 +51,37 @@ if product is None:
     # product name is the name of the docs sub-folder
     product = parts[docs_index + 1]
 
+# ----- Regular expressions -------
+
+# Compiled once at module load instead of on every call
+_EXPORT_CONST_RE = re.compile(r'export const (\w+)\s*=\s*(.+?)(?:;|$)')
+_VARIABLE_REF_RE = re.compile(r'\$\{(\w+)\}')
+_DATA_CONST_RE = re.compile(r'const data = ({.*?});', re.DOTALL)
+_KEY_RE = re.compile(r'([A-Z_]+):')
+# <Vpd k="KEY" /> and <Vpl k="KEY" /> in a single pattern
+_LOCAL_VARIABLE_RE = re.compile(r'<Vp(d|l)\s+k="(\w+)"\s*/>')
+_TRIPLE_BLANK_RE = re.compile(r'\n([\s\t]*\n){3,}')
+# Import statements
+_IMPORT_COMPONENT_RE = re.compile(r'import\s+(\w+?)\s+from\s+\'(.+?md[x]*)\';?\n*')
+# Namespace and component import statements, removed in one pass
+_IMPORT_STATEMENT_RE = re.compile(r'import\s+\*[\s\w]*from\s+\'[a-zA-Z0-9@/]*?\';|import\s+\w+?\s+from\s+\'.+?md[x]*\';?\n*')
+# Document header and table of contents
+_HEADER_RE = re.compile(r"^---\ntitle:\s*'(.*)'[\s\S]*?\n---$", re.MULTILINE)
+_TOC_RE = re.compile(r'export\s+const\s+toc\s*=\s*\[\s*\{\s*\}\];')
+# <Vg k="KEY" /> global variables
+_VG_RE = re.compile(r'<Vg\s+k\s*=\s*"(\w+)"\s*\/?>')
+# Markdown images, one image at a time so that every image on a line is found
+_IMAGE_RE = re.compile(r'!\[.*?\]\(([^)\s]+)[^)]*\)')
+# <Link to="{{Global.KEY}}path">name</Link> tags
+_LINK_TAG_RE = re.compile(r'<Link\s+to=\"\{\{(?:[Gg]lobal?|GLOBAL)\.*([^\"]+)}}([^\"]*)\"\s*>(.*?)</Link>')
+# Markdown links, excluding images
+_HYPERLINK_RE = re.compile(r'(?<!\!)(\[.*?\]\()(.*?)(\))')
+# <PlatformWrapper> and <ProductWrapper> blocks
+_WRAPPER_RES = {
+    tagName: re.compile(r'^.*\<{}\s([\s\S]*?)>\n*([\s\S]*?)</{}>'.format(tagName, tagName), re.MULTILINE)
+    for tagName in ('PlatformWrapper', 'ProductWrapper')
+}
+
 # ----- Helper functions -------
 
 # Functions to recursively resolve variables in global.js to create a dictionary
@@ -52,7 +89,7 @@ def read_variables(file_path):
     variables = {}
     with open(file_path, 'r', encoding='utf-8') as file:
         for line in file:
-            match = re.match(r'export const (\w+)\s*=\s*(.+?)(?:;|$)', line)
+            match = _EXPORT_CONST_RE.match(line)
             if match:
                 variable_name, variable_value = match.groups()
                 variables[variable_name] = variable_value.strip().strip("'\"`")
@@ -66,12 +103,15 @@ def resolve_variables(variables):
     return resolved_variables
 
 def resolve_value(value, variables):
-    match = re.search(r'\$\{(\w+)\}', value)
-    while match:
-        variable_name = match.group(1)
-        variable_value = variables.get(variable_name, '')
-        value = value.replace(f'${{{variable_name}}}', variable_value)
-        match = re.search(r'\$\{(\w+)\}', value)
+    # Replace all ${NAME} references in one pass, repeat only for nested references.
+    # Nesting can't be deeper than the number of variables, which stops self-references
+    for _ in range(len(variables) + 1):
+        if '${' not in value:
+            break
+        new_value = _VARIABLE_REF_RE.sub(lambda match: variables.get(match.group(1), ''), value)
+        if new_value == value:
+            break
+        value = new_value
     return value
 
 # Load the product/platform variables dictionary
@@ -80,59 +120,86 @@ def createDictionary(path):
         data_file = f.read()
 
     # Extract the data from the file using regular expressions
-    data_str = re.search(r'const data = {(.*?)};', data_file, re.DOTALL).group(1)
-    data_str = '{' + data_str + '}'
-    data_str = re.sub(r'([A-Z_]+):', r'"\1":', data_str)
+    data_str = _DATA_CONST_RE.search(data_file).group(1)
+    data_str = _KEY_RE.sub(r'"\1":', data_str)
 
     # Convert the data string to a dictionary
-    data = eval(data_str)
+    data = ast.literal_eval(data_str)
     return data
 
 # Use the product and platform dictionaries to resolve <Vpd> and <Vpl> tags
 def resolve_local_variables(text, product, productDictionary, platform, platformDictionary):
-    text = re.sub(r'<Vpd\s+k="(\w+)"\s*/>', lambda match: productDictionary[product].get(match.group(1), match.group(0)), text)
-    text = re.sub(r'<Vpl\s+k="(\w+)"\s*/>', lambda match: platformDictionary[platform].get(match.group(1), match.group(0)), text)
-    return text
+    if '<Vp' not in text:
+        return text
+    # Look up the product and platform variables once instead of per match
+    variables = {
+        'd': productDictionary.get(product),
+        'l': platformDictionary.get(platform),
+    }
+    def replace(match):
+        kind = match.group(1)
+        if variables[kind] is None:
+            if kind == 'd':
+                raise ValueError(f"Unknown product: {product}")
+            raise ValueError(f"Unknown platform: {platform}")
+        return variables[kind].get(match.group(2), match.group(0))
+
+    return _LOCAL_VARIABLE_RE.sub(replace, text)
+
+# Converts the path in an import statement to an absolute file path.
+# Shared files are imported with the same relative path from many places
+@functools.lru_cache(maxsize=None)
+def resolve_import_path(base_dir, filepath):
+    filepath = filepath.replace('@docs', docsPath)
+    if not os.path.isabs(filepath):
+        filepath = os.path.abspath(os.path.join(base_dir, filepath))
+    return filepath
 
 # Recursively resolve import statements
+# Shared files are often imported more than once, so each file is resolved only once per run
+@functools.lru_cache(maxsize=None)
 def resolve_imports(mdxFilePath):
     base_dir = os.path.dirname(mdxFilePath)
-    with open(rf'{mdxFilePath}', 'r', encoding='utf-8') as file:
+    with open(mdxFilePath, 'r', encoding='utf-8') as file:
         mdxFileContents = file.read()
         mdxFileContents = resolve_tags(mdxFileContents, 'PlatformWrapper', 'platform', platform)
         mdxFileContents = resolve_tags(mdxFileContents, 'ProductWrapper', 'product',  product)
 
+    # Skip the import patterns for files without imports
+    if 'import' not in mdxFileContents:
+        return mdxFileContents
     # Read the import statements
-    matches = re.findall(r'import\s+(\w+?)\s+from\s+\'(.+?md[x]*)\';?\n*', mdxFileContents)
+    matches = _IMPORT_COMPONENT_RE.findall(mdxFileContents)
     if not matches:
         return mdxFileContents
     # Delete import statements
-    mdxFileContents = re.sub(r'import\s+\*[\s\w]*from\s+\'[a-zA-Z0-9@/]*?\';' , "", mdxFileContents)    
-    mdxFileContents = re.sub(r'import\s+(\w+?)\s+from\s+\'(.+?md[x]*)\';?\n*' , "", mdxFileContents)
-    # Replace tags with file content
+    mdxFileContents = _IMPORT_STATEMENT_RE.sub("", mdxFileContents)
+    # Resolve the content of each imported file
+    components = {}
     for tag, filepath in matches:
-        filepath = filepath.replace('@docs', docsPath)
-        if '/data/variables' in filepath:
+        if '/data/variables' in filepath or tag in components:
             continue
-        if not os.path.isabs(filepath):
-            filepath = os.path.abspath(os.path.join(base_dir, filepath))
+        filepath = resolve_import_path(base_dir, filepath)
 
-        tag_content = resolve_imports(filepath)
-        # Resolve PlatformWrapper and ProductWrapper tags
-        tag_content = resolve_tags(tag_content, 'PlatformWrapper', 'platform', platform)
-        tag_content = resolve_tags(tag_content, 'ProductWrapper', 'product', product)
+        # PlatformWrapper and ProductWrapper tags are resolved when the file is read
+        components[tag] = resolve_imports(filepath)
 
-        rgx = r'<{}[\s\S]*?/>'.format(tag)
-        mdxFileContents = re.sub(rgx, lambda match: tag_content, mdxFileContents)
+    # Replace all tags with file content in a single pass.
+    # Longer names come first so that <Setup /> does not match <SetupProject />
+    if components:
+        names = sorted(components, key=len, reverse=True)
+        rgx = r'<({})[\s\S]*?/>'.format('|'.join(names))
+        mdxFileContents = re.sub(rgx, lambda match: components[match.group(1)], mdxFileContents)
 
     return mdxFileContents
 
 # Resolves all ProductWrapper and PlatformWrapper tags keeps contents where 
 # the attribute value is present in the opening tag and discards irrelevant content.
 def resolve_tags(text, tagName, attributeName, attributeValue):
+    if '<' + tagName not in text:
+        return text
     # pattern to match the <PlatformWrapper> block
-    regex = r'^.*\<{}\s([\s\S]*?)>\n*([\s\S]*?)</{}>'.format(tagName, tagName)
-    pattern = re.compile(regex, re.MULTILINE)
+    pattern = _WRAPPER_RES[tagName]
 
     # Replace the matches based on platform value
     # text = pattern.sub(lambda m: m.group(2) if attributeValue in m.group(1) else '', text)
@@ -142,84 +209,102 @@ def resolve_tags(text, tagName, attributeName, attributeValue):
     return text
 
 def resolve_header(text):
-    regex = r"^---\ntitle:\s*'(.*)'[\s\S]*?\n---$"
     replacement = r"# \1"
 
-    new_text = re.sub(regex, replacement, text, flags=re.MULTILINE|re.DOTALL)
-    new_text = re.sub(r'export\s+const\s+toc\s*=\s*\[\s*\{\s*\}\];', '', new_text)
+    new_text = _HEADER_RE.sub(replacement, text)
+    if 'toc' in new_text:
+        new_text = _TOC_RE.sub('', new_text)
     return new_text
 
 
-def resolve_images(text):
-    # Find all matches of the image link pattern
-    matches = re.findall(r'!\[.*\]\((.+)\)', text)
-
-    if matches:
-        # create the images directory if it doesn't exist
-        if not os.path.exists('./output/images'):
-            os.makedirs('./output/images')
+# Copy an image unless an identical copy exists from a previous run.
+# Images are flattened into ./output/images, so a file with the same name
+# may have been copied from a different source and its content must be compared
+def copy_image(source, destination):
+    try:
+        if (os.path.getsize(destination) == os.path.getsize(source)
+                and filecmp.cmp(source, destination, shallow=False)):
+            return
+    except FileNotFoundError:
+        pass
+    shutil.copyfile(source, destination)
 
-    # Copy each image to the ./images folder and update the paths
-    for match in matches:
-        if match.startswith('http') or match.startswith('https'):
+def resolve_images(text):
+    if '![' not in text:
+        return text
+    # Images to copy, keyed by destination so that each file is written once
+    copies = {}
+    # New path of each image, keyed by its path in the repository
+    paths = {}
+
+    for path in _IMAGE_RE.findall(text):
+        if path.startswith('http') or path.startswith('https') or path in paths:
             continue
         # Get the filename from the path
-        filename = match.split('/')[-1]
-        # Copy the file to the ./images folder
-        shutil.copyfile(assetsPath + match, f'./output/images/{filename}')
-        # Update the path in the markdown file
-        text = re.sub(match, f'./images/{filename}', text)
-
-    return text
+        filename = path.split('/')[-1]
+        copies[imagesPath + '/' + filename] = assetsPath + path
+        paths[path] = './images/' + filename
 
-def resolve_link_tags(text):
-    # Resolve <Link to="">name</Link> tags
-    pattern = re.compile(r'<Link\s+to=\"\{\{(?:[Gg]lobal?|GLOBAL)\.*([^\"]+)}}([^\"]*)\"\s*>(.*?)</Link>')
-    def replace(match):
-        url_key = match.group(1)
-        url = globalVariables.get(url_key)
-        if url is None:
-            raise ValueError(f"Unknown URL key: {url_key}")
-        link = match.group(2)
-        name = match.group(3)
-        return f'<a href="{url}{link}">{name}</a>'
-
-    return pattern.sub(replace, text)
-
-
-def resolve_hyperlinks(text, base_folder, http_url):
-    # Find all links in the text
-    pattern = r'(?<!\!)\[.*?\]\((.*?)\)'
-    links = re.findall(pattern, text)
-
-    # Loop through the links and resolve them
-    for link in links:
-        # Skip links that start with "http" or "https"
-        if link.startswith('http') or link.startswith('#'):
-            continue
-        elif link.startswith('.'):
-            # Resolve relative links with respect to the base folder
-            resolved_link = os.path.abspath(os.path.join(base_folder, link))
-            rel_path = os.path.relpath(resolved_link, docsPath)
-        else: 
-            # Resolve links with respect to the docs 'folder'
-            rel_path = link
+    if not paths:
+        return text
 
-        # Create the new URL by adding the HTTP prefix
-        new_url = '{}/{}'.format(http_url, rel_path.replace('\\','/'))
-        new_url= new_url.replace('//','/')
+    # Update every occurrence of the image paths in the markdown file in a single pass,
+    # so that a path is never matched again inside an already updated one
+    pattern = re.compile('|'.join(re.escape(path) for path in sorted(paths, key=len, reverse=True)))
+    text = pattern.sub(lambda match: paths[match.group(0)], text)
 
-        # Replace the link in the text
-        text = text.replace(link, new_url)
+    # Copy the files to the ./images folder, the copies are independent of each other
+    os.makedirs(imagesPath, exist_ok=True)
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        list(executor.map(copy_image, copies.values(), copies.keys()))
 
     return text
 
+# Replace a single <Link to="">name</Link> match with an html link
+def replace_link_tag(match):
+    url_key = match.group(1)
+    url = globalVariables.get(url_key)
+    if url is None:
+        raise ValueError(f"Unknown URL key: {url_key}")
+    link = match.group(2)
+    name = match.group(3)
+    return f'<a href="{url}{link}">{name}</a>'
+
+# Convert a markdown link target to a docs url.
+# Pages often repeat the same links, so each target is converted once
+@functools.lru_cache(maxsize=4096)
+def resolve_hyperlink(link, base_folder, http_url):
+    # Skip links that start with "http" or "https"
+    if link.startswith('http') or link.startswith('#'):
+        return link
+    elif link.startswith('.'):
+        # Resolve relative links with respect to the base folder
+        resolved_link = os.path.abspath(os.path.join(base_folder, link))
+        rel_path = os.path.relpath(resolved_link, docsPath)
+    else: 
+        # Resolve links with respect to the docs 'folder'
+        rel_path = link
+
+    # Create the new URL by adding the HTTP prefix
+    new_url = '{}/{}'.format(http_url, rel_path.replace('\\','/'))
+    new_url= new_url.replace('//','/')
+    return new_url
+
+# Resolve <Link> tags, then markdown links.
+# The tags are converted in their own pass first, a markdown link label may contain a <Link> tag
+def resolve_links(text, base_folder, http_url):
+    if '<Link' in text:
+        text = _LINK_TAG_RE.sub(replace_link_tag, text)
+    if '](' not in text:
+        return text
 
-# -----Main------
+    def replace(match):
+        return match.group(1) + resolve_hyperlink(match.group(2), base_folder, http_url) + match.group(3)
+
+    return _HYPERLINK_RE.sub(replace, text)
 
-# Read the input file
-with open(mdxPath, 'r', encoding='utf-8') as file:
-    contents = file.read()
+
+# -----Main------
 
 # Load global variables into a dictionary
 file_path = docsPath + '/shared/variables/global.js'
@@ -234,8 +319,8 @@ platformDict = createDictionary(docsPath + '/shared/variables/platform.js')
 mdxContents = resolve_imports(mdxPath)
 
 # Replace global variables <Vg k="KEY" /> using the dictionary
-regex_pattern = r'<Vg\s+k\s*=\s*"(\w+)"\s*\/?>'
-mdxContents = re.sub(regex_pattern, lambda match: globalVariables.get(match.group(1), match.group(0)), mdxContents)
+if '<Vg' in mdxContents:
+    mdxContents = _VG_RE.sub(lambda match: globalVariables.get(match.group(1), match.group(0)), mdxContents)
 
 # Replace product and platform variables <Vpd k="KEY" />, <Vpl k="KEY" />
 mdxContents = resolve_local_variables(mdxContents, product, productDict, platform, platformDict)
@@ -244,21 +329,21 @@ mdxContents = resolve_local_variables(mdxContents, product, productDict, platfor
 mdxContents = resolve_header(mdxContents)
 
 # Remove extra line breaks
-mdxContents = re.sub(r'\n([\s\t]*\n){3,}', r'\n\n', mdxContents)
+mdxContents = _TRIPLE_BLANK_RE.sub(r'\n\n', mdxContents)
 
 # Copy images and update image links
 mdxContents = resolve_images(mdxContents)
 
 # Update hyperlinks
-mdxContents = resolve_link_tags(mdxContents)
 docFolder = os.path.dirname(mdxPath)
-mdxContents = resolve_hyperlinks(mdxContents, docFolder, siteBaseUrl)
+mdxContents = resolve_links(mdxContents, docFolder, siteBaseUrl)
 
 # Write the modified contents to a new md file
-if not os.path.exists('./output'):
-    os.makedirs('./output')
-outputFilename = os.path.basename(mdxPath)
-outputFilename = os.path.splitext(outputFilename)[0] + '.md'
-with open('./output/' + outputFilename, 'w', encoding='utf-8') as file:
-    file.write(mdxContents)
+os.makedirs(outputPath, exist_ok=True)
+outputFilename = os.path.splitext(os.path.basename(mdxPath))[0] + '.md'
+outputFile = outputPath + '/' + outputFilename
+# Write to a temporary file and rename it so an interrupted run never leaves a truncated file
+with open(outputFile + '.tmp', 'wb') as file:
+    file.write(mdxContents.encode('utf-8'))
+os.replace(outputFile + '.tmp', outputFile)
     
\ No newline at end of file